@@ -4,7 +4,14 @@
 # -- IMPORTS ----------------------------------------------------------------- #
 
 import os
+import re
 import datetime
+import functools
+from itertools import chain
+from multiprocessing.pool import ThreadPool
+
+from lxml import etree
+from bs4 import SoupStrainer
 
 from carqueries import utils
 
@@ -12,8 +19,36 @@ from carqueries import utils
 # ---------------------------------------------------------------------------- #
 # -- GLOBALS ----------------------------------------------------------------- #
 
-# for determining vehical age
-CURRENT_YEAR = datetime.datetime.now().year
+# the leading number of a listing field (e.g. "$15,995" or "12 mi away").
+NUMBER_REGEX = re.compile(r'\d[\d,]*')
+
+# model years in a listing title, cars didn't exist before 1980.
+TITLE_YEAR_REGEX = re.compile(r'\b(198[1-9]|199\d|[2-9]\d{3})\b')
+
+# listing title tokens that indicate the sale type.
+SALE_TYPE_TOKENS = frozenset(('used', 'new', 'certified'))
+
+
+# ---------------------------------------------------------------------------- #
+# -- FUNCTIONS --------------------------------------------------------------- #
+
+def get_current_year():
+    """
+    Gets the current year for determining vehical age. This is looked up on
+    demand so that long running sessions don't go stale at the new year.
+    """
+    return datetime.date.today().year
+
+
+def get_quality(price, mileage, age):
+    """
+    Gets a derived number representing the suggested quality of an auto
+    from its price, mileage and age in years.
+    """
+    quality = float(price) / 500.0
+    quality -= float(mileage) / 10000.0
+    quality -= float(age) / 2.0
+    return int(round(quality))
 
 
 # ---------------------------------------------------------------------------- #
@@ -40,10 +75,12 @@ class RecordSort(object):
 # ---------------------------------------------------------------------------- #
 # -- CLASSES ----------------------------------------------------------------- #
 
+@functools.total_ordering
 class BaseAuto(object):
     """
     Base class for the AutoMake/AutoModel classes below.
     """
+    __slots__ = ('parent', 'token', 'label')
     JSON_KEY = None
     DROPDOWN_ID = None
 
@@ -127,13 +164,13 @@ class BaseAuto(object):
         """
         return not self.__eq__(other)
 
-    def __cmp__(self, other):
+    def __lt__(self, other):
         """
         Comparison for soring behavior.
         """
         if isinstance(other, type(self)):
-            return cmp(self.uuid, other.uuid)
-        return 1
+            return self.uuid < other.uuid
+        return NotImplemented
 
     def __str__(self):
         """
@@ -152,6 +189,7 @@ class AutoMake(BaseAuto):
     """
     Represents an automotive manufacturer (e.g. Ford, Toyota, Aston Martin).
     """
+    __slots__ = ('models',)
     JSON_KEY = 'makeS'
     DROPDOWN_ID = 'makeDropdown'
 
@@ -185,6 +223,8 @@ class AutoModel(BaseAuto):
     """
     Represents a specific model of car (e.g. Ford Model-T).
     """
+    # cached property values.
+    __slots__ = ('_title', '_uuid', '_title_tokens')
     JSON_KEY = 'models'
     DROPDOWN_ID = 'modelDropdown'
 
@@ -202,20 +242,28 @@ class AutoModel(BaseAuto):
         """
         return self.parent
 
-    @property
+    @utils.cached_property
     def title(self):
         """
         Gets a human readable title '<make> <model>".
         """
         return '{0} {1}'.format(self.make.label, self.label)
 
-    @property
+    @utils.cached_property
     def uuid(self):
         """
         A unique identifier for this info.
         """
         return '{0}_{1}'.format(self.make.token, self.token)
 
+    @utils.cached_property
+    def title_tokens(self):
+        """
+        The lower case listing title tokens already known from this model.
+        """
+        tokens = (self.make.label.lower(), self.label.lower())
+        return SALE_TYPE_TOKENS.union(tokens)
+
     def get_url_args(self):
         """
         Gets the URL arguments used to construct a query on this auto model.
@@ -227,15 +275,41 @@ class AutoModel(BaseAuto):
         Determines a url that presents auto records of this
         make and model use the input filters.
         """
-        args = self.get_url_args()
-        params = query.get_url_params(page)
-        return utils.get_url(args, params)
+        url = utils.get_url(self.get_url_args())
+        return url + '?' + query.get_url_query(page)
+
+
+class RecordFields(dict):
+    """
+    The field values of an auto record. Fields that were not parsed from the
+    listing fall through to the shared AutoRecord.DEFAULTS rather than being
+    copied into every record.
+    """
+    __slots__ = ()
+
+    def __missing__(self, key):
+        """
+        Falls back to the default value of fields missing from the record.
+        """
+        return AutoRecord.DEFAULTS[key]
+
+    def get(self, key, default=None):
+        """
+        Gets a field value, falling back to the record defaults.
+        """
+        if key in self:
+            return dict.__getitem__(self, key)
+        return AutoRecord.DEFAULTS.get(key, default)
 
 
 class AutoRecord(BaseAuto):
     """
     Represents a database record for a specific for-sale auto record.
     """
+    # record data, frequently read fields and cached property values.
+    __slots__ = ('auto_model', 'fields', 'year', 'price', 'mileage', 'style',
+                 '_sale_type', '_title', '_ttl', '_total', '_age', '_quality',
+                 '_sort_key', '_hash', '_str')
     NUMERIC_KEYS = ('year', 'price', 'mileage', 'distance',
                     'current-index', 'listing-id', 'owner-id')
     LISTING_TYPES = {
@@ -243,6 +317,7 @@ class AutoRecord(BaseAuto):
                      'js-new-listing':'new',
                      'js-certified-listing':'certified'
                      }
+    LISTING_TYPE_KEYS = frozenset(LISTING_TYPES)
     DEFAULTS = dict(
         sale_type='Unknown', title='Unknown', doors='Unknown',
         style='Unknown', engine='Unknown', dealer='Unknown',
@@ -250,92 +325,103 @@ class AutoRecord(BaseAuto):
         transmission='Unknown', thumb='', image='',
         year=0, mileage=0, price=0, index=0,
         listing_id=0, owner_id=0,
-        html_class=list()
+        html_class=()
         )
 
-    @classmethod
-    def from_soup(cls, auto_model, soup):
-        """
-        Parse auto records from page soup.
-        """
-        records = set()
-        for element in soup.find_all(cls._find_listing):
-            records.add(cls.parse_record(auto_model, element))
-        return records
+    # compiled XPath queries, evaluated by lxml rather than walked in Python.
+    LISTING_XPATH = etree.XPath('//' + utils.get_class_xpath('div', 'listing'))
+    PRICE_XPATH = etree.XPath('string(.//{0}//span)'.format(
+        utils.get_class_xpath('div', 'price-info')), smart_strings=False)
+    NAME_XPATH = etree.XPath('string(.//{0})'.format(
+        utils.get_class_xpath('a', 'js-vehicle-name')), smart_strings=False)
+    THUMBNAIL_XPATH = etree.XPath('.//{0}//img/@data-src'.format(
+        utils.get_class_xpath('a', 'js-vehicle-image')), smart_strings=False)
 
-    @staticmethod
-    def _find_listing(soup):
+    @classmethod
+    def from_tree(cls, auto_model, tree):
         """
-        Indicates if the input HTML element is an automotive listing.
+        Parse auto records from an lxml page tree.
         """
-        if soup is not None and soup.name == 'div' and soup.has_attr('class'):
-            return 'listing' in soup.get('class')
-        return False
+        # de-duplicate on the raw listing id, skipping repeated listings.
+        records = dict()
+        for element in cls.LISTING_XPATH(tree):
+            listing_id = element.get('data-listing-id')
+            if listing_id not in records:
+                records[listing_id] = cls.parse_record(auto_model, element)
+        return list(records.values())
 
     @classmethod
     def parse_record(cls, auto_model, element):
         """
-        Loads a auto record from a BeautifulSoup element.
+        Loads a auto record from an lxml listing element.
         """
-        html_classes = element['class']
+        html_classes = element.get('class', '').split()
         kwargs = dict(cls=html_classes,
                       thumbnail=None,
                       auto_model=auto_model)
-        for html_cls in html_classes:
-            if html_cls in cls.LISTING_TYPES:
-                kwargs['sale_type'] = cls.LISTING_TYPES[html_cls]
-                break
-        price = element.find('div', class_='price-info')
-        kwargs['price'] = price.span.text.strip() if price else None
-        anchor = element.find('a', class_='js-vehicle-name')
-        kwargs['title'] = str(anchor.text.strip()) if anchor else None
-        anchor = element.find('a', class_='js-vehicle-image')
-        if anchor is not None:
-            img = anchor.find('img')
-            if img is not None and img.get('data-src'):
-                kwargs['thumbnail'] = 'http:' + img['data-src']
+        listing_types = cls.LISTING_TYPE_KEYS.intersection(html_classes)
+        if listing_types:
+            kwargs['sale_type'] = cls.LISTING_TYPES[next(iter(listing_types))]
+        kwargs['price'] = cls.PRICE_XPATH(element).strip() or None
+        title = cls.NAME_XPATH(element).strip()
+        kwargs['title'] = str(title) if title else None
+        thumbnails = [t for t in cls.THUMBNAIL_XPATH(element) if t]
+        if thumbnails:
+            kwargs['thumbnail'] = 'http:' + thumbnails[0]
         # kwargs['thumb'] = 'http:' + anchor.div['data-background-image']
         for key in ('current-index', 'engine', 'listing-id',
                     'listing-type', 'manufacturer', 'owner-id'):
             kwargs[key.replace('-', '_')] = str(element.get('data-' + key))
-        for paragraph in element.find_all('p'):
+        for paragraph in element.iter('p'):
             key, value = cls.parse_data_element(paragraph)
             if key and value:
                 kwargs[key] = value
         # parse numeric values from strings
         for key in cls.NUMERIC_KEYS:
-            kwargs[key] = utils.parse_number(kwargs.get(key, None))
-        if kwargs['title']:
+            match = NUMBER_REGEX.search(kwargs.get(key) or '')
+            kwargs[key] = int(match.group().replace(',', '')) if match else 0
+        title = kwargs['title']
+        if title:
             # parse information from the title of the listing.
-            tokens = [t.strip('._ ') for t in kwargs['title'].split(' ')]
-            years = [int(t) for t in tokens if t.isdigit()]
-            # cars didn't exist before 1980
-            years = [t for t in years if t > 1980]
+            years = TITLE_YEAR_REGEX.findall(title)
             if years:
-                kwargs['year'] = years[0]
-            # strip tokens we already know from the title
-            strip_tokens = [auto_model.make.label, auto_model.label]
-            strip_tokens += ['used', 'new', 'certified']
-            strip_tokens += [y for y in years]
-            strip_tokens = [str(t).lower() for t in strip_tokens]
-            if any(t.lower() == 'certified' for t in tokens):
+                kwargs['year'] = int(years[0])
+            tokens = [t.strip('._ ') for t in title.split(' ')]
+            lower_tokens = [t.lower() for t in tokens]
+            if 'certified' in lower_tokens:
                 kwargs['sale_type'] = 'certified'
-            style = [t for t in tokens if t.lower() not in strip_tokens]
+            # strip tokens we already know from the title
+            strip_tokens = auto_model.title_tokens.union(years)
+            style = [t for t, lower in zip(tokens, lower_tokens)
+                     if lower not in strip_tokens]
             if style:
                 # anything left is typically the car body type or trim
                 kwargs['style'] = ' '.join(style)
         return cls(**kwargs)
 
+    @classmethod
+    def batch_quality(cls, records):
+        """
+        Computes the quality of all input records in a single pass, caching
+        the value on each record.
+        """
+        # the year is looked up once for the batch rather than per record.
+        current_year = get_current_year()
+        for record in records:
+            # prime the cached quality property.
+            record._quality = get_quality(
+                record.price, record.mileage, current_year - record.year)
+
     @classmethod
     def parse_data_element(cls, element):
         """
         Parse a data element.
         """
-        html_cls = element.get('class')
+        html_cls = frozenset(element.get('class', '').split())
         if 'paragraph-two' not in html_cls:
             return None, None
         key = None
-        value = element.text.strip()
+        value = ''.join(element.itertext()).strip()
         for name in ('dealer-name', 'distance'):
             if name in html_cls:
                 key = name
@@ -356,11 +442,21 @@ class AutoRecord(BaseAuto):
         Initialization.
         """
         self.auto_model = auto_model
-        self.fields = dict(self.DEFAULTS)
-        self.fields.update(kwargs)
+        # fields are not modified after initialization, which allows
+        # the derived properties below to be cached.
+        self.fields = RecordFields(kwargs)
+        # promote fields read during sorting, filtering and display.
+        self.year = self.fields['year']
+        self.price = self.fields['price']
+        self.mileage = self.fields['mileage']
+        self.style = self.fields['style']
         token = kwargs['listing_id']
         label = kwargs['title']
         super(AutoRecord, self).__init__(auto_model, token, label)
+        # records are hashed and printed repeatedly, compute both once.
+        self._hash = hash(token)
+        self._str = ' '.join(str(s) for s in (self.style, self.sale_type,
+                                              self.year))
 
     def get_url(self):
         """
@@ -372,7 +468,9 @@ class AutoRecord(BaseAuto):
         """
         JSON safe serialization.
         """
-        return dict(self.fields)
+        data = self.DEFAULTS.copy()
+        data.update(self.fields)
+        return data
 
     def data(self, column):
         """
@@ -381,10 +479,10 @@ class AutoRecord(BaseAuto):
         """
         return self.fields.get(column.name)
 
-    @property
+    @utils.cached_property
     def sale_type(self):
         sale_type = self.fields['sale_type'].lower()
-        title = self.fields['title'].lower()
+        title = (self.fields['title'] or '').lower()
         if 'certified' in title or sale_type == 'certified':
             return 'C'
         if sale_type == 'used':
@@ -393,10 +491,10 @@ class AutoRecord(BaseAuto):
             return 'N'
         return sale_type
 
-    @property
+    @utils.cached_property
     def title(self):
-        if self.fields['style'] != 'Unknown':
-            return self.fields['style']
+        if self.style != 'Unknown':
+            return self.style
         return self.fields['title']
 
     @property
@@ -414,17 +512,14 @@ class AutoRecord(BaseAuto):
     def doors(self):
         return self.fields['doors']
 
-    @property
-    def style(self):
-        return self.fields['style']
-
     @property
     def engine(self):
         return self.fields['engine']
 
     @property
     def dealer(self):
-        return self.fields['dealer-name']
+        # parsed as "dealer-name", the default is stored under "dealer".
+        return self.fields.get('dealer-name', self.DEFAULTS['dealer'])
 
     @property
     def distance(self):
@@ -442,19 +537,7 @@ class AutoRecord(BaseAuto):
     def transmission(self):
         return self.fields['transmission']
 
-    @property
-    def year(self):
-        return self.fields['year']
-
-    @property
-    def mileage(self):
-        return self.fields['mileage']
-
-    @property
-    def price(self):
-        return self.fields['price']
-
-    @property
+    @utils.cached_property
     def ttl(self):
         """
         Gets the estimated tax title and license fees.
@@ -463,13 +546,20 @@ class AutoRecord(BaseAuto):
         title = 50  # rough estimate
         return tax + title
 
-    @property
+    @utils.cached_property
     def total(self):
         """
         Gets the estimated out-the-door price for this record.
         """
         return self.price + self.ttl
 
+    @utils.cached_property
+    def sort_key(self):
+        """
+        The key records are ordered by, computed once rather than per comparison.
+        """
+        return (self.title or '', self.year)
+
     @property
     def listing_id(self):
         return self.fields['listing_id']
@@ -482,33 +572,30 @@ class AutoRecord(BaseAuto):
     def html_class(self):
         return self.fields['html_class']
 
-    @property
+    @utils.cached_property
     def age(self):
-        return CURRENT_YEAR - self.year
+        return get_current_year() - self.year
 
-    @property
+    @utils.cached_property
     def quality(self):
         """
         Retrieves a derived number representing the
         suggested quality of the auto.
         """
-        quality = float(self.price) / 500.0
-        quality -= float(self.mileage) / 10000.0
-        quality -= float(self.age) / 2.0
-        return int(round(quality))
+        return get_quality(self.price, self.mileage, self.age)
 
     def __hash__(self):
         """
         Handles the hash representation of this auto record.
         """
-        return hash(self.listing_id)
+        return self._hash
 
     def __eq__(self, other):
         """
         Equalty operator override.
         """
         if isinstance(other, AutoRecord):
-            return self.listing_id == other.listing_id
+            return self.token == other.token
         return False
 
     def __ne__(self, other):
@@ -516,22 +603,22 @@ class AutoRecord(BaseAuto):
         Inequalty operator override.
         """
         if isinstance(other, AutoRecord):
-            return self.listing_id != other.listing_id
+            return self.token != other.token
         return True
 
-    def __cmp__(self, other):
+    def __lt__(self, other):
         """
         Overrides Python comparison/sorting behavior.
         """
         if not isinstance(other, AutoRecord):
-            return 1
-        return cmp(self.title, other.title)
+            return NotImplemented
+        return self.sort_key < other.sort_key
 
     def __str__(self):
         """
         String representation.
         """
-        return ' '.join(str(s) for s in (self.style, self.sale_type, self.year))
+        return self._str
 
 
 class AutoSet(object):
@@ -539,6 +626,11 @@ class AutoSet(object):
     A set of auto make/model records.
     """
     CACHE_NAME = 'make_models.json'
+    # number of make pages requested concurrently during a refresh.
+    NUM_WORKERS = 8
+    # only the make/model drop-downs are parsed from refreshed pages.
+    DROPDOWN_STRAINER = SoupStrainer(id=[AutoMake.DROPDOWN_ID,
+                                         AutoModel.DROPDOWN_ID])
     
     @classmethod
     def auto_load(cls, session, path=None):
@@ -564,6 +656,9 @@ class AutoSet(object):
         self.models = set()
         self.makes_by_id = dict()
         self.models_by_id = dict()
+        self.autos_by_id = dict()
+        self.autos_by_term = dict()
+        self.autos_by_lower_term = dict()
         self.path = path
     
     def iter_makes(self):
@@ -582,21 +677,42 @@ class AutoSet(object):
         """
         Gets the automotive make by a search string.
         """
-        for make in self.makes:
-            if make.matches(make_term):
-                return make
-        return None
+        return self.find_term(None, make_term)
     
     def get(self, make_term, model_term):
         """
         Gets the automotive model by make and model search strings.
         """
         make = self.get_make(make_term)
-        if make is not None:
-            for model in make.models:
-                if model.matches(model_term):
-                    return model
-        return None
+        if make is None:
+            return None
+        return self.find_term(make.token, model_term)
+
+    def find_term(self, scope, term):
+        """
+        Finds the auto matching the search term within the scope, a make
+        token for models or None for makes. Exact terms are matched first,
+        then case insensitively.
+        """
+        auto = self.autos_by_term.get((scope, term))
+        if auto is None:
+            auto = self.autos_by_lower_term.get((scope, term.lower()))
+        return auto
+
+    def index_terms(self, scope, autos):
+        """
+        Adds the search terms of the input autos to the term indexes.
+        """
+        # like a linear search, the first auto matching an exact term wins.
+        for auto in autos:
+            for term in (auto.token, auto.label, auto.uuid):
+                self.autos_by_term.setdefault((scope, term), auto)
+        # case insensitive tokens and uuids take precedence over labels.
+        for attrs in (('token', 'uuid'), ('label',)):
+            for auto in autos:
+                for attr in attrs:
+                    key = (scope, getattr(auto, attr).lower())
+                    self.autos_by_lower_term.setdefault(key, auto)
 
     def load(self):
         """
@@ -604,27 +720,76 @@ class AutoSet(object):
         """
         with utils.InputFile(self.path, 'r') as input_fd:
             serialized = input_fd.read_json()
-        self.populate([AutoMake.deserialize(None, s) for s in serialized])
+        if isinstance(serialized, list):
+            # legacy cache of nested make/model dictionaries.
+            self.populate([AutoMake.deserialize(None, s) for s in serialized])
+        else:
+            self.populate(self.deserialize(serialized))
 
     def save(self):
         """
         Saves the auto make/models to the specified JSON file.
         """
         with utils.OutputFile(self.path) as output_fd:
-            output_fd.write_json([k.serialize() for k in self.makes])
+            output_fd.write_json(self.serialize())
+
+    def serialize(self):
+        """
+        Retrieves a JSON serializable representation of this set as flat,
+        parallel lists of make and model attributes. Models reference
+        their make by its index in the make lists.
+        """
+        data = dict(make_tokens=list(), make_labels=list(),
+                    model_makes=list(), model_tokens=list(),
+                    model_labels=list())
+        for index, make in enumerate(self.makes):
+            data['make_tokens'].append(make.token)
+            data['make_labels'].append(make.label)
+            for model in make.models:
+                data['model_makes'].append(index)
+                data['model_tokens'].append(model.token)
+                data['model_labels'].append(model.label)
+        return data
+
+    @staticmethod
+    def deserialize(data):
+        """
+        Rebuilds the list of auto makes, with their models,
+        from the flat JSON representation.
+        """
+        makes = [AutoMake(None, token, label) for token, label
+                 in zip(data['make_tokens'], data['make_labels'])]
+        models = zip(data['model_makes'], data['model_tokens'],
+                     data['model_labels'])
+        for index, token, label in models:
+            make = makes[index]
+            make.models.append(AutoModel(make, token, label))
+        return makes
 
     def refresh(self, session):
         """
         Refreshes all Auto Make/Model listings from kbb.
         """
         for_sale = (utils.CAR_FOR_SALE,)
-        soup = session.get_page_soup(utils.get_url(for_sale))
+        strainer = self.DROPDOWN_STRAINER
+        soup = session.get_page_soup(utils.get_url(for_sale), strainer=strainer)
         makes = AutoMake.from_soup(None, soup)
-        for make in makes:
+
+        def get_models(make):
             params = dict(atcmakecode=make.token)
             url = utils.get_url(for_sale, params)
-            soup = session.get_page_soup(url, sleep=False)
-            make.models = AutoModel.from_soup(make, soup)
+            soup = session.get_page_soup(url, sleep=False, strainer=strainer)
+            return AutoModel.from_soup(make, soup)
+
+        # each make is a separate page request, fetch them concurrently.
+        pool = ThreadPool(self.NUM_WORKERS)
+        try:
+            models = pool.map(get_models, makes)
+        finally:
+            pool.close()
+            pool.join()
+        for make, make_models in zip(makes, models):
+            make.models = make_models
         self.populate(makes)
 
     def populate(self, makes):
@@ -634,18 +799,29 @@ class AutoSet(object):
         self.makes = set(makes)
         self.makes_by_id = dict((k.uuid, k) for k in self.makes)
 
-        self.models = set(utils.flatten(k.models for k in self.makes))
-        self.models_by_id = dict((m.uuid, m) for m in self.models)
+        models = chain.from_iterable(k.models for k in self.makes)
+        self.models_by_id = dict((m.uuid, m) for m in models)
+        self.models = set(self.models_by_id.values())
+        # makes and models share a single index, their uuids are disjoint.
+        self.autos_by_id = dict(self.makes_by_id)
+        self.autos_by_id.update(self.models_by_id)
+
+        # search terms, indexed in a fixed order so lookups are repeatable.
+        self.autos_by_term = dict()
+        self.autos_by_lower_term = dict()
+        makes = sorted(self.makes)
+        self.index_terms(None, makes)
+        for make in makes:
+            self.index_terms(make.token, make.models)
 
     def __getitem__(self, key):
         """
         Provides dictionary like access to the set.
         """
-        if key in self.models_by_id:
-            return self.models_by_id[key]
-        if key in self.makes_by_id:
-            return self.makes_by_id[key]
-        raise KeyError('Unknown auto token "{0}".'.format(key))
+        try:
+            return self.autos_by_id[key]
+        except KeyError:
+            raise KeyError('Unknown auto token "{0}".'.format(key))
 
     def __len__(self):
         """
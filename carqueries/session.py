@@ -19,9 +19,15 @@ from carqueries.auto import AutoMake, AutoMake, AutoRecord, Distance, RecordSort
 import os
 import time
 import math
-import urllib2
-
-import json
+import threading
+from multiprocessing.pool import ThreadPool
+
+import requests
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+from lxml import etree
 from bs4 import BeautifulSoup
 
 from carqueries import utils
@@ -34,6 +40,8 @@ class Session(object):
     """
     ZIP_COOKIES = ('ZipCode', 'PersistentZipCode')
     VERSION = 3  # version for save data forward compatability
+    TIMEOUT = 30  # seconds to wait on a page request
+    REQUEST_INTERVAL = 1.0  # minimum seconds between requests to prevent DOS
 
     def __init__(self):
         """
@@ -43,9 +51,18 @@ class Session(object):
 
         self.query = None
         self.zipcode = None
-        self.cookies = None
+        # a persistent HTTP session holding the site cookies. requests
+        # sessions are not thread safe, each thread requests pages through
+        # its own copy, see get_http.
+        self.http = requests.Session()
+        self.thread_http = threading.local()
+        # spaces out requests made from any thread, see wait_for_request.
+        self.request_lock = threading.Lock()
+        self.domain_locks = dict()
+        self.last_request = dict()
         self.tree_model = None
         self.progress = dict()
+        self.progress_total = 0.0
 
         self.populate_cookies()
         self.auto_set = AutoSet.auto_load(self)
@@ -58,7 +75,12 @@ class Session(object):
         self.query = query
         self.set_zipcode(query.zipcode)
         self.progress = dict.fromkeys(query.auto_models, 0.0)
-        self.tree_model = TreeModel(query.populate(self), self.directory)
+        self.progress_total = 0.0
+        records = query.populate(self)
+        # download all thumbnails up front rather than one per tree row.
+        urls = set(r.thumbnail for r in records if r.thumbnail)
+        utils.WebImage.prefetch_all(self.directory, urls)
+        self.tree_model = TreeModel(records, self.directory)
         # self.save()
         return self.tree_model
 
@@ -66,18 +88,20 @@ class Session(object):
         """
         Populates default cookies... om nom nom nom nom.
         """
-        # request = urllib2.Request(DOMAIN + '?zipcode=' + zipcode)
-        response = urllib2.urlopen(urllib2.Request(utils.DOMAIN))
-        cookies = response.headers.get('Set-Cookie').split('; ')
-        inc = lambda c: not any(c.startswith(p + '=') for p in self.ZIP_COOKIES)
-        self.cookies = filter(inc, cookies)
+        self.http.get(utils.DOMAIN, timeout=self.TIMEOUT)
+        # zip code cookies are assigned by the session, not the site.
+        for cookie in list(self.http.cookies):
+            if cookie.name in self.ZIP_COOKIES:
+                self.http.cookies.clear(cookie.domain, cookie.path, cookie.name)
 
     def update_progress(self, auto_model, progress):
         """
         Updates the overall progress loading data.
         """
+        # keep a running total rather than summing every model per update.
+        self.progress_total += progress - self.progress.get(auto_model, 0.0)
         self.progress[auto_model] = progress
-        overall = float(sum(self.progress.values())) / len(self.progress)
+        overall = self.progress_total / len(self.progress)
         overall *= 100
         utils.print_line('Progress: {0:.1f}% ({1})'.format(overall, auto_model))
 
@@ -89,38 +113,94 @@ class Session(object):
         if self.zipcode != zipcode:
             # zip code has changed, clear any cached records.
             self.zipcode = zipcode
+            for cookie in self.ZIP_COOKIES:
+                self.http.cookies.set(cookie, zipcode)
+            # threads copy the changed cookies on their next request.
+            self.thread_http = threading.local()
+
+    def get_page_tree(self, url, sleep=True):
+        """
+        Gets the lxml element tree for the specified auto records listing page.
+        """
+        return self.parse_page_tree(self.get_page_payload(url, sleep))
+
+    @staticmethod
+    def parse_page_tree(payload):
+        """
+        Parses the lxml element tree from a raw HTML payload.
+        """
+        if not payload:
+            return None
+        # the page is parsed once, straight into a plain lxml.etree tree which
+        # avoids lxml.html's custom element classes. None if unparsable.
+        return etree.HTML(payload)
 
-    def get_page_soup(self, url, sleep=True):
+    def get_page_soup(self, url, sleep=True, strainer=None):
         """
-        Gets the soup for the specified auto records listing page.
+        Gets the soup for the specified auto records listing page. An optional
+        SoupStrainer limits parsing to the matching parts of the page.
         """
-        response = self.get_page_response(url)
+        payload = self.get_page_payload(url, sleep)
+        if payload is None:
+            return None
+        # BeautifulSoup can handle malformed HTML unlike ElementTree,
+        # the lxml tree builder does so considerably faster than html.parser.
+        return BeautifulSoup(payload, 'lxml', parse_only=strainer)
+
+    def get_page_payload(self, url, sleep=True):
+        """
+        Gets the raw HTML payload of the specified page.
+        """
+        response = self.get_page_response(url, sleep)
         if response is None:
             return None
-        payload = response.read()
-        if sleep:
-            time.sleep(1.0)  # brief sleep to prevent DOS.
-        # BeautifulSoup can handle malformed HTML unlike ElementTree.
-        return BeautifulSoup(payload, 'html.parser')
+        return response.content
+
+    def get_http(self):
+        """
+        Gets the calling thread's HTTP session, created on first use
+        with a copy of the shared session's cookies.
+        """
+        http = getattr(self.thread_http, 'session', None)
+        if http is None:
+            http = requests.Session()
+            http.cookies.update(self.http.cookies)
+            self.thread_http.session = http
+        return http
 
-    def get_page_response(self, url):
+    def wait_for_request(self, url):
+        """
+        Blocks until the request interval has passed since the previous
+        request to the same domain. Waiting threads are released one
+        request at a time, requests to other domains are not held up.
+        """
+        domain = urlparse(url).netloc
+        with self.request_lock:
+            if domain not in self.domain_locks:
+                self.domain_locks[domain] = threading.Lock()
+            domain_lock = self.domain_locks[domain]
+        with domain_lock:
+            last = self.last_request.get(domain, 0.0)
+            delay = last + self.REQUEST_INTERVAL - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.last_request[domain] = time.time()
+
+    def get_page_response(self, url, sleep=True):
         """
         Executes a GET request on the specified URL and returns
-        the urllb2 response object.
+        the requests response object.
         """
-        cookies = list(self.cookies)
-        if self.zipcode:
-            for cookie in self.ZIP_COOKIES:
-                cookies.append(cookie + '=' + str(self.zipcode))
-        request = urllib2.Request(url)
-        request.add_header('cookie', '; '.join(cookies))
+        if sleep:
+            self.wait_for_request(url)
+        response = self.get_http().get(url, timeout=self.TIMEOUT)
         try:
-            response = urllib2.urlopen(request)
-        except urllib2.HTTPError as err:
+            response.raise_for_status()
+        except requests.HTTPError as err:
             utils.print_line(str(err))
             utils.print_line(str(url))
             return None
-        if response.getcode() != 200:
+        if response.status_code != 200:
             raise RuntimeError('Request failed for URL: ' + url)
         return response
 
@@ -128,13 +208,8 @@ class Session(object):
         """
         Gets the list of unique values for the specified column.
         """
-        entries = dict()
-        for record in self.records.itervalues():
-            if not record.get_is_hidden():
-                data = tuple(record.data(c) for c in columns)
-                entries.setdefault(data, 0)
-                entries[data] += 1
-        return entries
+        # the hidden state lives on the tree rows of the populated model.
+        return self.tree_model.get_unique_values(columns)
 
     def get_auto_model(self, make_term, model_term):
         """
@@ -150,6 +225,11 @@ class Session(object):
         data.pop('root', None)
         data.pop('directory', None)
         data.pop('progress', None)
+        data.pop('progress_total', None)
+        data.pop('http', None)
+        data.pop('request_lock', None)
+        data.pop('domain_locks', None)
+        data.pop('last_request', None)
         make_models = data.pop('make_models', None)
         data['make_models'] = [m.serialize() for m in make_models]
         data['records'] = [r.serialize() for r in self.records.itervalues()]
@@ -173,13 +253,10 @@ class Session(object):
             directory = self.directory
         else:
             self.directory = directory
-        encoder = json.JSONEncoder()
-        data_str = encoder.encode(self.serialize())
         path = os.path.join(directory, 'session.dat')
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        with open(path, 'w') as output_fd:
-            output_fd.write(data_str)
+        # OutputFile encodes with orjson when available, else stdlib json.
+        with utils.OutputFile(path, binary=True) as output_file:
+            output_file.write_json(self.serialize())
 
     def iter_tree(self):
         """
@@ -211,6 +288,10 @@ class AutoQuery(object):
     Manages auto record query parameters.
     """
     NUM_RECORDS = 100
+    NUM_WORKERS = 4  # number of auto models queried concurrently
+    NUM_FETCHERS = 2  # number of pages downloaded ahead of parsing per model
+    TOTAL_XPATH = etree.XPath('//' + utils.get_class_xpath('span',
+                                                           'filter-highlight'))
 
     @classmethod
     def deserialize(cls, data):
@@ -250,59 +331,84 @@ class AutoQuery(object):
         if distance is None:
             distance = Distance.M100
         self.distance = distance
-        self.records = set()
+        # records keyed by their listing token, duplicates replace each other.
+        self.records = dict()
         self.loadtime = None
+        self._params_str = None
 
     def populate(self, session):
         """
         Populates records using the query information.
         """
         self.records.clear()
-        for auto_model in self.auto_models:
-            session.update_progress(auto_model, 0.0)
+        lock = threading.Lock()
+
+        def populate_model(auto_model):
+            with lock:
+                session.update_progress(auto_model, 0.0)
             for records, progress in self._iter_records(session, auto_model):
-                self.records.update(records)
-                session.update_progress(auto_model, progress)
+                with lock:
+                    self.records.update((r.token, r) for r in records)
+                    session.update_progress(auto_model, progress)
             # session.update_progress(auto_model, 1.0)
+
+        # auto models are queried concurrently, the session spaces out
+        # the actual requests while pages are parsed on other threads.
+        pool = ThreadPool(self.NUM_WORKERS)
+        try:
+            pool.map(populate_model, self.auto_models)
+        finally:
+            pool.close()
+            pool.join()
         self.loadtime = time.time()
-        records = list(self.records)
-        records.sort()
+        records = sorted(self.records.values())
+        AutoRecord.batch_quality(records)
         return records
 
     def _iter_records(self, session, model):
         """
         Iterates over the parsed auto record page results.
         """
-        # parse records from page results.
-        num_pages = 1
-        page = 1
-        while page <= num_pages:
-            url = model.get_for_sale_url(page, self)
-            soup = session.get_page_soup(url)
-            records = dict()
-            if soup is not None:
-                records = AutoRecord.from_soup(model, soup)
-            if page == 1:
-                # pares the total number of expected pages.
-                num_pages = self._get_num_pages(soup)
-            # each iteration yields two values:
-            # dictionary of parsed records, fractional progress in total pages
-            progress = float(page) / float(num_pages)
-            yield records, progress
-            if soup is None:
-                # no response or unparsable result
-                break
-            page += 1
-
-    def _get_num_pages(self, soup):
-        """
-        Gets the number of automotive record pages indicated in the HTML soup.
-        """
-        if soup is None:
+        # the first page determines the total number of expected pages.
+        tree = session.get_page_tree(model.get_for_sale_url(1, self))
+        num_pages = self._get_num_pages(tree)
+        records = list()
+        if tree is not None:
+            records = AutoRecord.from_tree(model, tree)
+        # each iteration yields two values:
+        # list of parsed records, fractional progress in total pages
+        yield records, 1.0 / num_pages
+        if tree is None or num_pages == 1:
+            return
+        # remaining pages are downloaded ahead on fetcher threads, in order,
+        # while the current page is parsed on this thread.
+        urls = [model.get_for_sale_url(p, self)
+                for p in range(2, num_pages + 1)]
+        pool = ThreadPool(min(self.NUM_FETCHERS, len(urls)))
+        try:
+            payloads = pool.imap(session.get_page_payload, urls)
+            for page, payload in enumerate(payloads, 2):
+                tree = session.parse_page_tree(payload)
+                records = list()
+                if tree is not None:
+                    records = AutoRecord.from_tree(model, tree)
+                yield records, float(page) / num_pages
+                if tree is None:
+                    # no response or unparsable result
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _get_num_pages(self, tree):
+        """
+        Gets the number of automotive record pages indicated in the HTML tree.
+        """
+        if tree is None:
             return 1
-        # page the total number of pages of results from HTML soup.
-        for span in soup.find_all('span', class_='filter-highlight'):
-            span_text = span.text.strip().lower()
+        # page the total number of pages of results from HTML tree.
+        for span in self.TOTAL_XPATH(tree):
+            span_text = ''.join(span.itertext()).strip().lower()
             if span_text.endswith(' cars'):
                 total = utils.parse_number(span_text)
                 return max(1, int(math.ceil(float(total) / self.NUM_RECORDS)))
@@ -319,19 +425,30 @@ class AutoQuery(object):
         if self.price:
             params.append(('pricerange', '{0:d}-{1:d}'.format(*self.price)))
         params.append(('distance', str(self.distance)))
-        if page:
-            params.append(('p', str(page)))
         params.append(('nr', self.NUM_RECORDS))
         params.append(('s', RecordSort.NEW_TO_OLD))
+        if page:
+            params.append(('p', str(page)))
         return params
 
+    def get_url_query(self, page=None):
+        """
+        Gets the URL query string for the specified page of results.
+        """
+        # only the page changes between requests, the rest is formatted once.
+        if self._params_str is None:
+            self._params_str = utils.params_to_url(self.get_url_params())
+        if page:
+            return self._params_str + '&p=' + str(page)
+        return self._params_str
+
     def serialize(self):
         """
         Retrieves a JSON serializable representation of this object.
         """
         data = dict()
         for key, value in vars(self).iteritems():
-            if value is not None:
+            if value is not None and not key.startswith('_'):
                 data[key] = value
         data['auto_models'] = self.auto_models
         return data
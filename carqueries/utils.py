@@ -7,11 +7,19 @@ import os
 import re
 import sys
 import json
+import codecs
 import errno
 import shutil
 import hashlib
-import urllib2
 import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    import orjson
+except ImportError:
+    # orjson is an optional, faster JSON backend.
+    orjson = None
 
 # ---------------------------------------------------------------------------- #
 # -- GLOBALS ----------------------------------------------------------------- #
@@ -33,7 +41,16 @@ RESOURCES = os.path.join(DIRECTORY, 'resources')
 ICON_DIR = os.path.join(RESOURCES, 'icons')
 NO_THUMB = os.path.join(RESOURCES, 'nothumb.jpeg')
 WINDOW_ICON = os.path.join(ICON_DIR, '{size}x{size}.png')
+# the icon built from the WINDOW_ICON files, on first use by get_window_icon.
+ICON = None
 CACHE_DIR = os.path.join(tempfile.gettempdir(), 'carquery')
+# directories already created or found by safe_makedirs.
+ENSURED_DIRS = set()
+
+# every byte that is not an ASCII digit, deleted by parse_number.
+NON_DIGITS = bytes(bytearray(c for c in range(256) if not 48 <= c <= 57))
+# a short alphanumeric file extension, e.g. "jpg".
+EXTENSION_REGEX = re.compile(r'^[a-z0-9]{1,4}$')
 
 # ---------------------------------------------------------------------------- #
 # -- FUNCTIONS --------------------------------------------------------------- #
@@ -42,12 +59,14 @@ def get_window_icon():
     """
     Gets the icon used to represent the application. 
     """
-    from qtpy import QtGui, QtCore
-    icon = QtGui.QIcon()
-    for size in (16, 24, 32, 48, 64, 256):
-        path = WINDOW_ICON.format(size=size)
-        icon.addFile(path, QtCore.QSize(size, size))
-    return icon
+    global ICON
+    if ICON is None:
+        from qtpy import QtGui, QtCore
+        ICON = QtGui.QIcon()
+        for size in (16, 24, 32, 48, 64, 256):
+            path = WINDOW_ICON.format(size=size)
+            ICON.addFile(path, QtCore.QSize(size, size))
+    return ICON
 
 
 def print_line(text, color=None, error=False, bold=False):
@@ -77,6 +96,26 @@ def get_url(args=None, params=None):
     return url
 
 
+def get_checksum(text):
+    """
+    Gets a hex digest of the input text, used to name cached files.
+    """
+    data = text.encode('utf-8')
+    # the digest is not cryptographic, prefer the faster BLAKE2 when present.
+    if hasattr(hashlib, 'blake2b'):
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+    return hashlib.md5(data).hexdigest()
+
+
+def get_class_xpath(tag, html_cls):
+    """
+    Gets an XPath step matching elements of the specified tag that
+    include the input HTML class among their class tokens.
+    """
+    predicate = "contains(concat(' ', normalize-space(@class), ' '), ' {0} ')"
+    return '{0}[{1}]'.format(tag, predicate.format(html_cls))
+
+
 def params_to_url(params):
     """
     Converts GET parameters to a URL query string.
@@ -91,7 +130,10 @@ def parse_number(value, default=0):
     Parses an integer number from a string.
     """
     if isinstance(value, basestring):
-        value = re.sub('[^0-9]+', '', value)
+        # bytes.translate deletes the non-digits in a single C loop.
+        if not isinstance(value, bytes):
+            value = value.encode('ascii', 'ignore')
+        value = value.translate(None, NON_DIGITS)
         if value:
             return int(value)
     return default
@@ -101,11 +143,14 @@ def safe_makedirs(directory):
     """
     Creates the specified directory if it is missing.
     """
+    if directory in ENSURED_DIRS:
+        return
     try:
         os.makedirs(directory)
     except OSError as e:
         if e.errno != errno.EEXIST:
             raise
+    ENSURED_DIRS.add(directory)
 
 
 def to_price(value):
@@ -123,20 +168,11 @@ def to_decimal(value):
     return '{0:.1f}'.format(float(value))
 
 
-def flatten(in_list):
-    """
-    Flattens two-deep nested iterables.
-    """
-    return [item for sublist in in_list for item in sublist]
-
-
 def write_file(path, data, binary=True):
     """
     Writes the specified data to disk.
     """
-    directory = os.path.dirname(path)
-    if not os.path.isdir(directory):
-        os.makedirs(directory)
+    safe_makedirs(os.path.dirname(path))
     with open(path, 'wb' if binary else 'w') as out_fd:
         out_fd.write(data)
 
@@ -165,8 +201,7 @@ class TermColor(object):
         """
         if IS_WINDOWS:
             return str(text)
-        kwargs = dict(color=self.code, text=text, escape=self.DEFAULT)
-        return '{color}{text}{escape}'.format(**kwargs)
+        return self.code + text + self.DEFAULT
 
 
 class TermColors(object):
@@ -189,6 +224,36 @@ class TermColors(object):
 # ---------------------------------------------------------------------------- #
 # -- CLASSES ----------------------------------------------------------------- #
 
+class cached_property(object):
+    """
+    A read-only property decorator that computes its value once
+    and caches it on the instance for all subsequent lookups.
+
+    The value is stored in the "_<name>" attribute of the instance, which
+    classes using __slots__ must declare.
+    """
+    def __init__(self, func):
+        """
+        Initialization.
+        """
+        self.func = func
+        self.attr = '_' + func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner=None):
+        """
+        Gets the cached value, computing it on first access.
+        """
+        if instance is None:
+            return self
+        try:
+            return getattr(instance, self.attr)
+        except AttributeError:
+            value = self.func(instance)
+            setattr(instance, self.attr, value)
+            return value
+
+
 class File(object):
     """
     A context manager for interacting with files on disk.
@@ -254,6 +319,8 @@ class InputFile(File):
         Reads and returns JSON data from disk.
         """
         data = self.read()
+        if orjson is not None:
+            return orjson.loads(data)
         return json.JSONDecoder().decode(data)
         
     def read(self):
@@ -274,7 +341,19 @@ class OutputFile(File):
         """
         Writes the specified data to a JSON representation on disk.
         """
-        self.write(json.JSONEncoder().encode(serialized))
+        if orjson is not None:
+            # stdlib json stringifies non-string keys, match it.
+            data = orjson.dumps(serialized, option=orjson.OPT_NON_STR_KEYS)
+            if not self.binary:
+                data = data.decode('utf-8')
+            self.write(data)
+        else:
+            self.validate_locked()
+            descriptor = self.descriptor
+            if self.binary:
+                descriptor = codecs.getwriter('utf-8')(descriptor)
+            # json.dump streams chunks rather than building the whole string.
+            json.dump(serialized, descriptor)
         
     def write(self, data):
         """
@@ -289,6 +368,11 @@ class WebImage(object):
     An image loaded from a web URL.
     """
     BY_URL = dict()
+    NUM_WORKERS = 8  # number of images downloaded concurrently
+    TIMEOUT = 30  # seconds to wait on an image request
+    # HTTP sessions keeping connections to image hosts alive, one per
+    # downloading thread as requests sessions are not thread safe.
+    HTTP = threading.local()
 
     @classmethod
     def instance(cls, local_dir, url):
@@ -296,20 +380,70 @@ class WebImage(object):
             cls.BY_URL[url] = cls(local_dir, url)
         return cls.BY_URL[url]
 
+    @classmethod
+    def prefetch_all(cls, local_dir, urls):
+        """
+        Downloads the images for all input URLs missing on disk in parallel.
+        """
+        missing = dict()
+        for url in urls:
+            path = cls.get_path(local_dir, url)
+            if not os.path.isfile(path):
+                missing[path] = url
+        if not missing:
+            return
+        safe_makedirs(os.path.join(local_dir, 'images'))
+        pool = ThreadPool(min(cls.NUM_WORKERS, len(missing)))
+        try:
+            pool.map(lambda item: cls.download(*item), missing.items())
+        finally:
+            pool.close()
+            pool.join()
+
+    @classmethod
+    def get_path(cls, local_dir, url):
+        """
+        Gets the local path an image URL is cached to.
+        """
+        ext = url.rpartition('.')[2].lower()
+        if not EXTENSION_REGEX.match(ext):
+            ext = 'jpg'
+        name = get_checksum(url) + '.' + ext
+        return os.path.join(local_dir, 'images', name)
+
+    @classmethod
+    def get_http(cls):
+        """
+        Gets the calling thread's HTTP session, importing requests on
+        first use.
+        """
+        http = getattr(cls.HTTP, 'session', None)
+        if http is None:
+            import requests
+            http = cls.HTTP.session = requests.Session()
+        return http
+
+    @classmethod
+    def download(cls, path, url):
+        """
+        Downloads the image at the URL to the local path.
+        """
+        import requests
+        try:
+            response = cls.get_http().get(url, timeout=cls.TIMEOUT)
+            response.raise_for_status()
+        except requests.RequestException:
+            safe_makedirs(os.path.dirname(path))
+            shutil.copy(NO_THUMB, path)
+        else:
+            write_file(path, response.content, binary=True)
+
     def __init__(self, local_dir, url):
         """
         Initialization.
         """
         self.url = url
-        self.ext = 'jpg'
-        md5 = hashlib.md5()
-        md5.update(self.url)
-        self.checksum = md5.hexdigest()
-        ext = self.url.rpartition('.')[2].lower()
-        if re.match('^[a-z0-9]{1,4}$', ext):
-            self.ext = ext
-        name = self.checksum + '.' + self.ext
-        self.path = os.path.join(local_dir, 'images', name)
+        self.path = self.get_path(local_dir, url)
         self.pixmap = None
         self.load_image()
 
@@ -319,10 +453,5 @@ class WebImage(object):
         """
         from qtpy import QtGui
         if not os.path.isfile(self.path):
-            try:
-                data = urllib2.urlopen(self.url).read()
-            except urllib2.HTTPError:
-                shutil.copy(NO_THUMB, self.path)
-            else:
-                write_file(self.path, data, binary=True)
+            self.download(self.path, self.url)
         self.pixmap = QtGui.QPixmap(self.path)
@@ -4,7 +4,14 @@
 # -- IMPORTS ----------------------------------------------------------------- #
 
 import math
+import operator
 import webbrowser
+from collections import Counter
+try:
+    from sys import intern
+except ImportError:
+    # Python 2, intern is a builtin.
+    pass
 
 from qtpy import QtGui, QtCore, QtWidgets
 
@@ -116,6 +123,11 @@ class TreeModel(QtCore.QAbstractItemModel):
     """
     The data model of all automtive records displayed in the application's main view.
     """
+    # immutable display values, shared by every cell rather than rebuilt.
+    ALIGNMENT = QtCore.Qt.AlignCenter | QtCore.Qt.AlignVCenter
+    HIDDEN_BRUSH = QtGui.QBrush(QtGui.QColor(120, 120, 120))
+    VISIBLE_BRUSH = QtGui.QBrush(QtGui.QColor(230, 230, 230))
+
     def __init__(self, records, directory, **kwargs):
         """
         Initialization.
@@ -124,9 +136,14 @@ class TreeModel(QtCore.QAbstractItemModel):
         self.directory = directory 
         self.columns = TreeColumns.all()
         self.groupings = [TreeColumns.dealer, TreeColumns.model]
+        # bumped whenever a row is hidden or unhidden, see TreeRow.get_is_hidden.
+        self.hidden_generation = 0
         QtCore.QAbstractItemModel.__init__(self, **kwargs)
         self.root = RootRow()
         self.root.populate(self, None)
+        self.root.populate_index()
+        # the flattened tree, the structure is fixed once populated.
+        self.rows = list(self.root.iter_descendants())
 
     def flags(self, index):
         """
@@ -173,7 +190,7 @@ class TreeModel(QtCore.QAbstractItemModel):
             if role == QtCore.Qt.DisplayRole:
                 return self.columns[section].label
             if role == QtCore.Qt.TextAlignmentRole:
-                return QtCore.Qt.AlignCenter | QtCore.Qt.AlignVCenter
+                return self.ALIGNMENT
         return None
         
     def rowCount(self, index=None):
@@ -211,31 +228,44 @@ class TreeModel(QtCore.QAbstractItemModel):
         if role == QtCore.Qt.SizeHintRole:
             return row_obj.size(col)
         if role == QtCore.Qt.TextAlignmentRole:
-            return QtCore.Qt.AlignCenter | QtCore.Qt.AlignVCenter
+            return self.ALIGNMENT
         if role == QtCore.Qt.ForegroundRole:
             if row_obj.hidden:
-                return QtGui.QBrush(QtGui.QColor(120, 120, 120))
+                return self.HIDDEN_BRUSH
             else:
-                return QtGui.QBrush(QtGui.QColor(230, 230, 230))
+                return self.VISIBLE_BRUSH
         return None
 
     def get_unique_values(self, columns):
         """
         Gets the list of unique values for the specified column.
         """
-        entries = dict()
-        for record in self.records.itervalues():
-            if not record.get_is_hidden():
-                data = tuple(record.data(c) for c in columns)
-                entries.setdefault(data, 0)
-                entries[data] += 1
-        return entries
+        # hidden state lives on the tree rows, count the visible leaf rows.
+        rows = (r for r in self.iter_tree() if r.get_is_leaf())
+        return Counter(tuple(r.record.data(c) for c in columns)
+                       for r in rows if not r.get_is_hidden())
             
+    def rows_changed(self, rows):
+        """
+        Notifies views that the data of the input rows and their ancestors
+        changed, e.g. when hidden, without resetting the whole model.
+        """
+        last_column = len(self.columns) - 1
+        changed = set()
+        for row in rows:
+            for ancestor in row.iter_ancestors(include_self=True):
+                if ancestor in changed or not ancestor.index.isValid():
+                    continue
+                changed.add(ancestor)
+                index = ancestor.index
+                last = index.sibling(index.row(), last_column)
+                self.dataChanged.emit(index, last)
+
     def iter_tree(self):
         """
         Iterates over all rows in the tree.
         """
-        return self.root.iter_descendants(include_self=False)
+        return iter(self.rows)
 
 
 class ProxyTreeModel(QtCore.QSortFilterProxyModel):
@@ -255,16 +285,18 @@ class ProxyTreeModel(QtCore.QSortFilterProxyModel):
         """
         left_data = None
         right_data = None
-        model = self.sourceModel()
+        # both indexes are in the sorted column, look it up once.
+        column = self.sourceModel().columns[left_idx.column()]
         if left_idx.isValid():
-            left_row = left_idx.internalPointer()
-            col = model.columns[left_idx.column()]
-            left_data = left_row.data(col)
+            left_data = left_idx.internalPointer().data(column)
         if right_idx.isValid():
-            right_row = right_idx.internalPointer()
-            col = model.columns[right_idx.column()]
-            right_data = right_row.data(col)
-        return cmp(left_data, right_data) < 0
+            right_data = right_idx.internalPointer().data(column)
+        # missing values sort first, as they did with cmp().
+        if left_data is None:
+            return right_data is not None
+        if right_data is None:
+            return False
+        return left_data < right_data
 
     def filterAcceptsRow(self, row, parent):
         """
@@ -282,6 +314,8 @@ class TreeColumn(object):
     """
     A column in the main auto records tree view.
     """
+    __slots__ = ('name', 'label', 'data_type', 'number', 'width', 'format_str',
+                 'hidden', 'formatter', 'sizes', 'index')
     # index to recognize column declaration order.
     INDEX = 0
 
@@ -297,6 +331,9 @@ class TreeColumn(object):
         self.width = width
         self.format_str = format_str
         self.hidden = hidden
+        self.formatter = self.get_formatter()
+        # size hints by row height, shared by every cell of the column.
+        self.sizes = dict()
         self.index = self.INDEX
         type(self).INDEX += 1
     
@@ -308,6 +345,18 @@ class TreeColumn(object):
             return self.label.ljust(self.width)
         return self.label
 
+    def get_formatter(self):
+        """
+        Gets the callable converting data to a label, chosen once per column.
+        """
+        data_type = self.data_type
+        if self.format_str:
+            format_str = self.format_str.format
+            return lambda data: format_str(data_type(data))
+        if data_type is str:
+            return str
+        return lambda data: str(data_type(data))
+
     def get_average(self, values):
         """
         Gets the average of the input values for this column.
@@ -328,14 +377,9 @@ class TreeColumn(object):
         if data is None:
             return ''
         try:
-            data = self.data_type(data)
+            data_str = self.formatter(data)
         except (ValueError, TypeError):
             data_str = ''
-        else:
-            if self.format_str:
-                data_str = self.format_str.format(data)
-            else:
-                data_str = str(data)
         if padded:
             data_str = data_str.ljust(padded)
         return data_str
@@ -368,38 +412,57 @@ class TreeColumns(object):
     ttl = TreeColumn('TTL', int, 60, format_str='${0:,d}')
     total = TreeColumn('Total', int, 60, format_str='${0:,d}')
 
+    # the sorted visible columns and all columns by name, see all().
+    VISIBLE = None
+    BY_NAME = None
+
     @classmethod
     def all(cls):
         """
         Gets the ordered list of table columns.
         """
-        columns = list()
-        for key, value in vars(cls).iteritems():
-            if isinstance(value, TreeColumn):
-                value.name = key.lower()
-                if not value.hidden:
+        if cls.VISIBLE is None:
+            # columns are named and sorted once, on first use.
+            columns = list()
+            for key, value in vars(cls).items():
+                if isinstance(value, TreeColumn):
+                    value.name = intern(key.lower())
                     columns.append(value)
-        columns.sort()
-        return columns
+            columns.sort()
+            cls.BY_NAME = dict((c.name, c) for c in columns)
+            cls.VISIBLE = [c for c in columns if not c.hidden]
+        return list(cls.VISIBLE)
 
     @classmethod
     def get(cls, name):
         """
         Gets a column object by name.
         """
-        return getattr(cls, name.upper(), None)
+        cls.all()
+        return cls.BY_NAME.get(name.lower())
 
 
 class TreeRow(object):
     """
     Abstract base class for a auto model row.
     """
+    # slots rather than an instance dict, trees hold many rows.
+    __slots__ = ('hidden', 'hidden_cache', 'row_id', 'row_path', 'model',
+                 'index', 'parent', 'children', 'records', 'stats', 'sums',
+                 'counts', 'data_cache', 'label_cache', 'cache_generation')
+    # columns answered by a row attribute rather than a record average.
+    ACCESSORS = dict(image=operator.attrgetter('image'))
+
     def __init__(self, row_id):
         """
         Initialization.
         """
         self.hidden = False
+        # the resolved hidden state and the model generation it was taken at.
+        self.hidden_cache = (None, False)
         self.row_id = str(row_id).lower()
+        # the cached path of row ids from the root, see get_row_path.
+        self.row_path = None
         # the root data model object.
         self.model = None
         # The QModelIndex associated with this row.
@@ -410,6 +473,16 @@ class TreeRow(object):
         self.children = list()
         # the auto records included in row to be populated later.
         self.records = list()
+        # column statistics computed from the records, by column name.
+        self.stats = dict()
+        # numeric column sums and value counts of the records, by column name.
+        self.sums = dict()
+        self.counts = dict()
+        # column data and labels by column name, and the model hidden
+        # generation they were computed at; see validate_cache.
+        self.data_cache = dict()
+        self.label_cache = dict()
+        self.cache_generation = None
 
     def get_row_id(self):
         """
@@ -421,23 +494,36 @@ class TreeRow(object):
         """
         Gets a unique row path that identifies this row in the tree.
         """
-        row_ids = [r.row_id for r in self.iter_ancestors(include_self=True)]
-        return '/'.join(str(i) for i in reversed(row_ids))
+        # built from the parent's cached path, the tree is fixed once populated.
+        if self.row_path is None:
+            if isinstance(self.parent, TreeRow):
+                self.row_path = self.parent.get_row_path() + '/' + self.row_id
+            else:
+                self.row_path = self.row_id
+        return self.row_path
 
     def set_hidden(self, hidden):
         """
         Assigns the hidden state of this row.
         """
         self.hidden = hidden
+        if self.model is not None:
+            self.model.hidden_generation += 1
 
     def get_is_hidden(self):
         """
         Determines if this row is hidden or if any ancestor is hidden.
         """
-        for row in self.iter_ancestors(include_self=True):
-            if row.hidden:
-                return True
-        return False
+        model = self.model
+        if model is not None and self.hidden_cache[0] == model.hidden_generation:
+            return self.hidden_cache[1]
+        # resolved through the parent's cached state, not a full ancestor walk.
+        hidden = self.hidden
+        if not hidden and isinstance(self.parent, TreeRow):
+            hidden = self.parent.get_is_hidden()
+        if model is not None:
+            self.hidden_cache = (model.hidden_generation, hidden)
+        return hidden
 
     def populate(self, model, parent):
         """
@@ -461,21 +547,48 @@ class TreeRow(object):
             child.clear()
         self.records[:] = list()
         self.children[:] = list()
+        self.stats.clear()
+        self.sums.clear()
+        self.counts.clear()
+        self.data_cache.clear()
+        self.label_cache.clear()
+
+    def validate_cache(self):
+        """
+        Clears the cached column data and labels if any row was hidden or
+        unhidden since they were computed, record counts depend on it.
+        """
+        generation = getattr(self.model, 'hidden_generation', None)
+        if self.cache_generation != generation:
+            self.data_cache.clear()
+            self.label_cache.clear()
+            self.cache_generation = generation
 
     def label(self, column):
         """
         Retrieves the label from this row for the specified column.
         """
-        data = self.data(column)
-        return column.data_to_label(data)
+        self.validate_cache()
+        label = self.label_cache.get(column.name)
+        if label is None:
+            data = self.data(column)
+            label = self.label_cache[column.name] = column.data_to_label(data)
+        return label
 
     def data(self, column):
         """
         Retrieves model data for this make/model.
         """
-        if hasattr(self, column.name):
-            return getattr(self, column.name)
-        return self.get_average(column)
+        self.validate_cache()
+        if column.name in self.data_cache:
+            return self.data_cache[column.name]
+        accessor = self.ACCESSORS.get(column.name)
+        if accessor is not None:
+            data = accessor(self)
+        else:
+            data = self.get_average(column)
+        self.data_cache[column.name] = data
+        return data
 
     def decoration(self, column):
         """
@@ -487,7 +600,11 @@ class TreeRow(object):
         """
         Virtual method to get the size hint for the specified column of this row.
         """
-        return QtCore.QSize(column.width, self.get_row_height())
+        height = self.get_row_height()
+        size = column.sizes.get(height)
+        if size is None:
+            size = column.sizes[height] = QtCore.QSize(column.width, height)
+        return size
 
     def print_tree(self, depth=0):
         """
@@ -510,11 +627,12 @@ class TreeRow(object):
         """
         Iterates over the ancestors of this row.
         """
-        if include_self:
-            yield self
-        for child in self.children:
-            for descendant in child.iter_descendants(True):
-                yield descendant
+        # an explicit stack, rather than one nested generator per tree level.
+        stack = [self] if include_self else self.children[::-1]
+        while stack:
+            row = stack.pop()
+            yield row
+            stack.extend(reversed(row.children))
 
     def get_row_height(self):
         """
@@ -527,9 +645,29 @@ class TreeRow(object):
         Gets the average value for all records in the hierarchy
         below this row for the specified column.
         """
+        count = self.counts.get(column.name)
+        if count is not None:
+            # numeric averages come from the totals summed at populate time.
+            return float(self.sums[column.name]) / count if count else 0
         values = self.get_values(column)
         return column.get_average(values)
 
+    def populate_totals(self):
+        """
+        Sums the numeric column values of all records in a single pass.
+        """
+        # columns resolved by a row attribute, e.g. image, are not averaged.
+        columns = [c for c in self.model.columns
+                   if c.number and c.name not in self.ACCESSORS]
+        sums = self.sums = dict.fromkeys((c.name for c in columns), 0)
+        counts = self.counts = dict.fromkeys(sums, 0)
+        for record in self.records:
+            for column in columns:
+                value = record.data(column)
+                if value is not None:
+                    sums[column.name] += value
+                    counts[column.name] += 1
+
     def get_values(self, column):
         """
         Gets the list of values from the child records for the specified column.
@@ -553,21 +691,28 @@ class TreeRow(object):
         """
         Gets a dictionary stats about the specified column.
         """
-        values = self.get_values(column)
-        if not values:
-            dict(mean=0, minimum=0, maximum=0, stddev=0, count=0)
-        num_items = len(values)
-        mean = sum(values) / num_items
-        diffs = [x - mean for x in values]
-        sq_diffs = [d ** 2 for d in diffs]
-        stats = dict()
-        stats['stddev'] = math.sqrt(sum(sq_diffs) / num_items)
-        stats['mean'] = mean
-        stats['count'] = num_items
-        stats['minimum'] = min(values)
-        stats['maximum'] = max(values)
-        stats['range'] = stats['maximum'] - stats['minimum']
-        stats['median'] = (float(stats['range']) / 2.0) + stats['minimum']
+        # records only change when the row is populated, compute stats once.
+        if column.name in self.stats:
+            return self.stats[column.name]
+        # sorted once, the extremes and median are then read off by index.
+        values = sorted(self.get_values(column))
+        keys = ('mean', 'stddev', 'minimum', 'maximum', 'range', 'median')
+        stats = dict.fromkeys(keys, 0)
+        stats['count'] = num_items = len(values)
+        if values:
+            mean = math.fsum(values) / num_items
+            variance = math.fsum((x - mean) ** 2 for x in values) / num_items
+            stats['stddev'] = math.sqrt(variance)
+            stats['mean'] = mean
+            stats['minimum'] = values[0]
+            stats['maximum'] = values[-1]
+            stats['range'] = stats['maximum'] - stats['minimum']
+            middle = num_items // 2
+            if num_items % 2:
+                stats['median'] = values[middle]
+            else:
+                stats['median'] = (values[middle - 1] + values[middle]) / 2.0
+        self.stats[column.name] = stats
         return stats
 
     @property
@@ -599,7 +744,10 @@ class TreeGroup(TreeRow):
     """
     A row in the auto record tree that groups instances with a common field.
     """
-    def __init__(self, column, matcher, depth, row_id=None):
+    __slots__ = ('column', 'matcher', 'depth', 'title')
+    ACCESSORS = dict(TreeRow.ACCESSORS, title=operator.attrgetter('title'))
+
+    def __init__(self, column, matcher, depth, row_id=None, records=None):
         """
         Initialization.
         """
@@ -610,6 +758,9 @@ class TreeGroup(TreeRow):
         if row_id is None:
             row_id = '{0}_{1}'.format(column.name, matcher)
         super(TreeGroup, self).__init__(row_id)
+        if records is not None:
+            # records already grouped by the parent row.
+            self.records = records
 
     def populate(self, model, parent):
         """
@@ -617,8 +768,14 @@ class TreeGroup(TreeRow):
         """
         self.model = model
         self.parent = parent
-        self.records = [r for r in self.get_parent_records()
-                        if self._is_included(r)]
+        self.row_path = None
+        if not self.records:
+            self.records = [r for r in self.get_parent_records()
+                            if self._is_included(r)]
+        self.stats.clear()
+        self.data_cache.clear()
+        self.label_cache.clear()
+        self.populate_totals()
         self.children = self.create_children()
         for child in self.children:
             child.populate(model, self)
@@ -628,9 +785,14 @@ class TreeGroup(TreeRow):
             # reached leaf level rows.
             return [AutoRow(r) for r in self.records]
         column = self.model.groupings[self.depth]
-        values = self.get_unique_values(column)
+        # bucket the records by their grouping value in a single pass,
+        # rather than every child group scanning all of them.
+        groups = dict()
+        for record in self.records:
+            groups.setdefault(record.data(column), []).append(record)
         depth = self.depth + 1
-        return [TreeGroup(column, value, depth) for value in values]
+        return [TreeGroup(column, value, depth, records=records)
+                for value, records in groups.items()]
 
     def get_unique_values(self, column=None):
         """
@@ -648,6 +810,8 @@ class RootRow(TreeGroup):
     """
     A virtual row in the tree which populates top level items.
     """
+    __slots__ = ()
+
     def __init__(self):
         """
         Initialization.
@@ -680,11 +844,15 @@ class AutoRow(TreeRow):
     """
     Represents a leaf level tree row for an actual car for sale.
     """
+    __slots__ = ('record', 'thumbnail')
+
     def __init__(self, record):
         """
         Initialization.
         """
         self.record = record
+        # the thumbnail image, loaded when first displayed.
+        self.thumbnail = None
         super(AutoRow, self).__init__(record.token)
 
     def populate(self, model, parent):
@@ -693,11 +861,10 @@ class AutoRow(TreeRow):
         """
         self.model = model
         self.parent = parent
-        self.records = [self]
-        self.children = list()
-        url = self.record.thumbnail
-        if url is not None:
-            self.thumbnail = utils.WebImage.instance(model.directory, url)
+        self.row_path = None
+        # leaves never gain children, share one empty tuple between them.
+        self.records = (self,)
+        self.children = ()
 
     def get_row_height(self):
         """
@@ -723,19 +890,29 @@ class AutoRow(TreeRow):
         """
         if column is TreeColumns.image:
             return None
-        field = column.name
-        if hasattr(self, field):
-            return getattr(self, field)
-        return self.fields.get(field, None)
+        # leaf values are read straight off the record, which caches them.
+        return getattr(self.record, column.name, None)
 
     def decoration(self, column):
         """
         Virtual method to get custom cell decoration for this row.
         """
         if column is TreeColumns.image:
-            return self.thumbnail.pixmap
+            thumbnail = self.get_thumbnail()
+            if thumbnail is not None:
+                return thumbnail.pixmap
         return None
 
+    def get_thumbnail(self):
+        """
+        Gets the thumbnail image of the record, loading it on first use so
+        only rows that are actually displayed read their image.
+        """
+        url = self.record.thumbnail
+        if self.thumbnail is None and url is not None:
+            self.thumbnail = utils.WebImage.instance(self.model.directory, url)
+        return self.thumbnail
+
     def __str__(self):
         """
         String representation.
@@ -94,31 +94,46 @@ QMenu::item:selected {
         Shows hidden entries.
         """
         self.tree.proxy.show_hidden = self.show_hidden_action.isChecked()
-        self.tree.proxy.reset()
+        # only the filtered rows change, existing indexes remain valid.
+        self.tree.proxy.invalidateFilter()
 
     def hide_selected(self):
         """
         Hides the selected rows.
         """
-        for row in self.tree.get_selected_rows():
+        rows = self.tree.get_selected_rows()
+        for row in rows:
             row.set_hidden(True)
-        self.tree.proxy.invalidateFilter()
+        self.refresh_rows(rows)
 
     def unhide_selected(self):
         """
         Hides the selected rows.
         """
-        for row in self.tree.get_selected_rows():
+        rows = self.tree.get_selected_rows()
+        for row in rows:
             row.set_hidden(False)
-        self.tree.update()
+        self.refresh_rows(rows)
 
     def unhide_all(self):
         """
         Unhides all rows.
         """
-        for row in self.manager.iter_tree():
+        model = self.tree.proxy.sourceModel()
+        rows = [r for r in model.iter_tree() if r.hidden]
+        for row in rows:
             row.set_hidden(False)
-        self.tree.proxy.reset()
+        self.refresh_rows(rows)
+
+    def refresh_rows(self, rows):
+        """
+        Updates the view after the hidden state of the input rows changed.
+        """
+        if not rows:
+            return
+        # repaint just the changed rows and their ancestors' record counts,
+        # the dynamically filtering proxy re-filters the changed rows.
+        self.tree.proxy.sourceModel().rows_changed(rows)
 
     def save_session(self):
         """
@@ -8,41 +8,89 @@ import sys
 import atexit
 import ctypes
 
+try:
+    import resource
+except ImportError:
+    # resource is unix only.
+    resource = None
+
 from carqueries import utils
 
-try:
-    from qtpy import QtGui, QtWidgets
-except Exception:
-    # exception defined inside qtpy is raised here ;_;
-    HAS_QT = False
-else:
-    HAS_QT = True
-        
 # ---------------------------------------------------------------------------- #
 # -- GLOBALS ----------------------------------------------------------------- #
 
-# reasonable guess for maximum file handles
+# upper bound on file handles closed at exit, the soft limit where known.
 MAX_HANDLES = 1000
+if resource is not None:
+    _limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if _limit == resource.RLIM_INFINITY:
+        _limit = 65536
+    MAX_HANDLES = min(_limit, 65536)
+
+# the application's dark color scheme, by QPalette color role name.
+PALETTE_COLORS = (
+    ('Window', (75, 75, 75)),
+    ('WindowText', (255, 255, 255)),
+    ('Base', (55, 55, 55)),
+    ('AlternateBase', (100, 100, 100)),
+    ('ToolTipBase', (65, 65, 65)),
+    ('ToolTipText', (255, 255, 255)),
+    ('Text', (220, 220, 220)),
+    ('Button', (85, 85, 85)),
+    ('ButtonText', (220, 220, 220)),
+    ('BrightText', (220, 220, 220)),
+    ('Link', (255, 100, 10)),
+    ('Highlight', (255, 100, 10)),
+    ('HighlightedText', (220, 220, 220)),
+    )
+# the palette built from PALETTE_COLORS, on first use by get_palette.
+PALETTE = None
+
+if utils.IS_WINDOWS:
+    # Windows API functions, resolved and prototyped once.
+    SET_APP_ID = ctypes.WinDLL('shell32').SetCurrentProcessExplicitAppUserModelID
+    SET_APP_ID.argtypes = (ctypes.c_wchar_p,)
+    SET_APP_ID.restype = ctypes.c_long
+    MESSAGE_BOX = ctypes.WinDLL('user32').MessageBoxW
+    MESSAGE_BOX.argtypes = (ctypes.c_void_p, ctypes.c_wchar_p,
+                            ctypes.c_wchar_p, ctypes.c_uint)
+    MESSAGE_BOX.restype = ctypes.c_int
 
 # ---------------------------------------------------------------------------- #
 # -- FUNCTIONS --------------------------------------------------------------- #
 
+def close_handles():
+    """
+    Closes all file handles above the standard streams.
+    """
+    os.closerange(3, MAX_HANDLES)
+
+
+def close_handles_darwin():
+    """
+    Closes all file handles above the standard streams, except 7.
+    """
+    # trying to close 7 produces an illegal
+    # instruction on the Mac, close the ranges around it.
+    os.closerange(3, 7)
+    os.closerange(8, MAX_HANDLES)
+
+
+# the platform's handle closing, chosen once.
+if sys.platform == 'darwin':
+    close_handles = close_handles_darwin
+
+
 def safe_exit(exitcode):
     """
     Causes python to exit without garbage-collecting. This is a
     workaround for  common errors than occur in PyQt and PySide
     on exit.
     """
-    atexit._run_exitfuncs()
-    # close file handles
-    if sys.platform != 'darwin':
-        os.closerange(3, MAX_HANDLES)
-    else:
-        for fd in range(3, MAX_HANDLES):
-            # trying to close 7 produces an illegal
-            # instruction on the Mac.
-            if fd != 7:  
-                os.close(fd)
+    # Python 3 can report the registered exit functions without walking them.
+    if getattr(atexit, '_ncallbacks', lambda: 1)():
+        atexit._run_exitfuncs()
+    close_handles()
     os._exit(exitcode)
 
 
@@ -50,22 +98,13 @@ def get_palette():
     """
     Gets the default palette for the car queries application.
     """
-    palette = QtGui.QPalette()
-    palette.setColor(QtGui.QPalette.Window, QtGui.QColor(75,75,75))
-    palette.setColor(QtGui.QPalette.WindowText, QtGui.QColor(255, 255, 255))
-    palette.setColor(QtGui.QPalette.Base, QtGui.QColor(55, 55, 55))
-    palette.setColor(QtGui.QPalette.AlternateBase, QtGui.QColor(100, 100, 100))
-    palette.setColor(QtGui.QPalette.ToolTipBase, QtGui.QColor(65, 65, 65))
-    palette.setColor(QtGui.QPalette.ToolTipText, QtGui.QColor(255, 255, 255))
-    palette.setColor(QtGui.QPalette.Text, QtGui.QColor(220, 220, 220))
-    palette.setColor(QtGui.QPalette.Button, QtGui.QColor(85, 85, 85))
-    palette.setColor(QtGui.QPalette.ButtonText, QtGui.QColor(220, 220, 220))
-    palette.setColor(QtGui.QPalette.BrightText, QtGui.QColor(220, 220, 220))
-    palette.setColor(QtGui.QPalette.Link, QtGui.QColor(255, 100, 10))
-    palette.setColor(QtGui.QPalette.Highlight, QtGui.QColor(255, 100, 10))
-    palette.setColor(QtGui.QPalette.HighlightedText, 
-                     QtGui.QColor(220, 220, 220))
-    return palette
+    global PALETTE
+    if PALETTE is None:
+        from qtpy import QtGui
+        PALETTE = QtGui.QPalette()
+        for role, rgb in PALETTE_COLORS:
+            PALETTE.setColor(getattr(QtGui.QPalette, role), QtGui.QColor(*rgb))
+    return PALETTE
 
 # ---------------------------------------------------------------------------- #
 # -- APPLICATION ENTRY ------------------------------------------------------- #
@@ -76,22 +115,31 @@ def main():
     """
     if utils.IS_WINDOWS:
         app_id = u'twc.carquiries.1' # arbitrary string
-        ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(app_id)
-        
-    if not HAS_QT:
+        SET_APP_ID(app_id)
+
+    # Qt is only imported once it is actually needed.
+    try:
+        from qtpy import QtWidgets
+    except Exception:
+        # exception defined inside qtpy is raised here ;_;
+        has_qt = False
+    else:
+        has_qt = True
+
+    if not has_qt:
         if utils.IS_WINDOWS:
             # popup a generic Windows error message.
             msg = u'Missing requirement PyQt or PySide.'
             title = u'Missing Requirements'
-            ctypes.windll.user32.MessageBoxW(0, msg, title, 0)
+            MESSAGE_BOX(None, msg, title, 0)
         else:
             # Other systems such as Linux simply print to a terminal.
-            sys.stderr.write('Missing requirement PyQt or PySide.\n')
+            os.write(2, b'Missing requirement PyQt or PySide.\n')
         return 1
 
     # import here to ensure Qt has been successfully found and imported.
     from carqueries.windows import MainWindow
-    application = QtWidgets.QApplication(list(sys.argv))
+    application = QtWidgets.QApplication(sys.argv)
     application.setWindowIcon(utils.get_window_icon())
     application.setStyle(QtWidgets.QStyleFactory.create('Fusion'))
     application.setPalette(get_palette())
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+# ---------------------------------------------------------------------------- #
+# -- IMPORTS ----------------------------------------------------------------- #
+
+import unittest
+
+from carqueries import auto
+
+# ---------------------------------------------------------------------------- #
+# -- CLASSES ----------------------------------------------------------------- #
+
+class AutoSetLookupTest(unittest.TestCase):
+    """
+    Tests make and model lookups on the bundled auto set.
+    """
+    @classmethod
+    def setUpClass(cls):
+        """
+        Loads the bundled make/model listings once for all tests.
+        """
+        cls.auto_set = auto.AutoSet()
+        cls.auto_set.load()
+
+    def test_exact_label_lookup(self):
+        """
+        Exact labels resolve to their own model over colliding tokens.
+        """
+        self.assertEqual(self.auto_set.get('honda', 'Crosstour').token,
+                         'honcross')
+        self.assertEqual(self.auto_set.get('rr', 'Dawn').token, 'rrdawn')
+
+    def test_exact_token_lookup(self):
+        """
+        Exact tokens resolve to their own model over colliding labels.
+        """
+        self.assertEqual(self.auto_set.get('honda', 'crosstour').token,
+                         'crosstour')
+        self.assertEqual(self.auto_set.get('rr', 'dawn').token, 'dawn')
+
+    def test_case_insensitive_lookup(self):
+        """
+        Terms matching no exact key fall back to a case insensitive match.
+        """
+        self.assertEqual(self.auto_set.get('HONDA', 'CROSSTOUR').token,
+                         'crosstour')
+
+
+# ---------------------------------------------------------------------------- #
+# -- APPLICATION ENTRY ------------------------------------------------------- #
+
+if __name__ == '__main__':
+    unittest.main()